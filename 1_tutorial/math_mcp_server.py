@@ -1,4 +1,7 @@
 # math_mcp_server.py
+import re
+from typing import Any, Dict, List
+
 from fastmcp import FastMCP
 
 mcp = FastMCP(name="Math MCP Server", instructions="Provides basic math tools.")
@@ -25,6 +28,39 @@ def divide(a: float, b: float) -> float:
         raise ValueError("Division by zero is not allowed.")
     return a / b
 
+# The single-operation tools as plain functions (`.fn` is the undecorated function), shared with
+# batch_evaluate and with the UI's in-process evaluator.
+OPS = {tool.name: tool.fn for tool in (add, subtract, multiply, divide)}
+
+_result_ref_pattern = re.compile(r"RESULT_(\d+)")
+
+@mcp.tool()
+def batch_evaluate(steps: List[Dict[str, Any]]) -> List[float]:
+    """Evaluate a whole chain of {func, a, b} steps in one call; a or b may be "RESULT_N" (1-based).
+
+    Stops at the first failing step and reports it as an error.
+    """
+    results: List[float] = []
+    for i, step in enumerate(steps, start=1):
+        try:
+            if step.get("func") not in OPS:
+                raise ValueError(f"Unknown func. Allowed: {sorted(OPS)}")
+            operands = []
+            for value in (step["a"], step["b"]):
+                if isinstance(value, str):
+                    match = _result_ref_pattern.fullmatch(value)
+                    if match is None:
+                        raise ValueError(f"Expected a number or RESULT_N, got {value!r}")
+                    ref = int(match.group(1))
+                    if not 1 <= ref < i:
+                        raise ValueError(f"Bad result reference: {value}")
+                    value = results[ref - 1]
+                operands.append(value)
+            results.append(float(OPS[step["func"]](*operands)))
+        except Exception as e:
+            raise ValueError(f"Step {i} ({step.get('func')}): {e}") from e
+    return results
+
 if __name__ == "__main__":
     # Run the server over HTTP transport with streaming support
     mcp.run(transport="streamable-http", host="0.0.0.0", port=8000)
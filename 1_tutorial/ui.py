@@ -8,11 +8,14 @@ This app shows how to:
 
 Prerequisites
 -------------
-- Python 3.9+
+- Python 3.11+
 - `pip install streamlit openai fastmcp`
 - An MCP server running locally that exposes tools named: `add`, `subtract`, `multiply`, `divide`.
   For example, a server listening at `http://127.0.0.1:8000/mcp`.
 - An OpenAI API key (set `OPENAI_API_KEY` in your environment or Streamlit secrets).
+- Optional: `pip install msgspec orjson` for faster plan parsing and JSON rendering.
+- The LLM planner and MCP executor shared with the other tutorials live in `mcp_ui_core.py`
+  at the repository root; keep this file inside its tutorial folder so it can be found.
 
 Run
 ---
@@ -22,43 +25,87 @@ Run
 
 Notes
 -----
-- The LLM only *plans* the steps. It never computes directly; all math is done by the MCP tools.
-- The LLM is instructed to output a JSON array with steps like:
-  [{"func":"add","a":12,"b":8}, {"func":"multiply","a":"RESULT_1","b":8}]
+- The LLM only *plans* the steps. It never computes directly; all math is done by the tools.
+- By default the planned steps are evaluated in-process with the same semantics as the MCP tools;
+  switch off "Execute locally" in the sidebar to call the MCP server for every step.
+- The LLM replies with structured output (a JSON schema enforced by the API) like:
+  {"steps": [{"func":"add","a":12,"b":8}, {"func":"multiply","a":"RESULT_1","b":8}]}
 - A later step can refer to an earlier output as `RESULT_N` (1-based).
 """
 from __future__ import annotations
 
-import asyncio
-import json
+import ast
 import logging
 import os
 import re
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+import sys
+from dataclasses import asdict, dataclass
+from functools import cached_property
+from pathlib import Path
+from typing import Any, Dict, List, Literal, Optional, Union
 
 import streamlit as st
-from fastmcp import Client
-from openai import OpenAI
+from cachetools import LRUCache
+
+try:  # optional: parses and validates plans in one C pass
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# The planner/executor shared by all tutorial UIs lives in mcp_ui_core.py at the repo root.
+REPO_ROOT = str(Path(__file__).resolve().parent.parent)
+if REPO_ROOT not in sys.path:  # the script's top level re-runs on every Streamlit rerun
+    sys.path.insert(0, REPO_ROOT)
+import mcp_ui_core as core  # noqa: E402
+# Local evaluation uses the server's own tool functions, so the two paths cannot drift apart.
+from math_mcp_server import OPS as LOCAL_OPS  # noqa: E402
 
 # -----------------------------------------------------------------------------
 # Configuration & constants
 # -----------------------------------------------------------------------------
 ALLOWED_FUNCS = {"add", "subtract", "multiply", "divide"}
-DEFAULT_MODEL = "gpt-3.5-turbo"  # Use any chat-completions-capable model you prefer
-MCP_BASE_URL = os.getenv("MCP_BASE_URL", "http://127.0.0.1:8000/mcp")
 
 SYSTEM_PROMPT = (
     "You are a math tool-calling assistant. "
     "Given a user question, break it into a step-by-step chain of JSON tool calls. "
     "Allowed tools: add, subtract, multiply, divide. "
-    "Each tool call should be a JSON object: {\"func\":..., \"a\":..., \"b\":...}. "
-    "Output a JSON array in correct calculation order. "
+    "List the steps in correct calculation order. "
     "Use the result of a previous step as \"a\" or \"b\" in later steps as needed, by referring to it as RESULT_N where N is the 1-based step index.\n"
     "Example: What is (12 + 8) * 8?\n"
-    "[{\"func\":\"add\",\"a\":12,\"b\":8}, {\"func\":\"multiply\",\"a\":\"RESULT_1\",\"b\":8}]\n"
+    "{\"steps\":[{\"func\":\"add\",\"a\":12,\"b\":8}, {\"func\":\"multiply\",\"a\":\"RESULT_1\",\"b\":8}]}\n"
 )
 
+# Structured output schema for the plan: the API guarantees replies match it, so there is
+# no code-fence stripping or string-to-number coercion on the way in.
+_OPERAND_SCHEMA = {"anyOf": [{"type": "number"}, {"type": "string", "pattern": "^RESULT_[0-9]+$"}]}
+PLAN_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "tool_chain",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "steps": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "func": {"type": "string", "enum": sorted(ALLOWED_FUNCS)},
+                            "a": _OPERAND_SCHEMA,
+                            "b": _OPERAND_SCHEMA,
+                        },
+                        "required": ["func", "a", "b"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["steps"],
+            "additionalProperties": False,
+        },
+    },
+}
+
 # -----------------------------------------------------------------------------
 # Data structures
 # -----------------------------------------------------------------------------
@@ -69,6 +116,16 @@ class ToolCall:
     a: Any
     b: Any
 
+    @property
+    def args(self) -> Dict[str, Any]:
+        """Tool arguments as sent to the MCP server."""
+        return {"a": self.a, "b": self.b}
+
+    @cached_property
+    def refs(self) -> List[int]:
+        """Step indices this step references as RESULT_N, computed once per plan step."""
+        return core.find_result_refs(self.a, self.b)
+
     @classmethod
     def from_obj(cls, obj: Dict[str, Any]) -> "ToolCall":
         if not isinstance(obj, dict):
@@ -80,125 +137,162 @@ class ToolCall:
             raise ValueError(f"Invalid func '{func}'. Allowed: {sorted(ALLOWED_FUNCS)}")
         return cls(func=func, a=a, b=b)
 
-# -----------------------------------------------------------------------------
-# Utilities
-# -----------------------------------------------------------------------------
-_code_fence_pattern = re.compile(r"^```[a-zA-Z0-9]*\n|\n```$", re.MULTILINE)
 
+if msgspec is not None:
+    class PlanStep(msgspec.Struct):
+        """Typed view of one plan step; mirrors the items of ``PLAN_RESPONSE_FORMAT``."""
+        func: Literal["add", "subtract", "multiply", "divide"]
+        a: Union[int, float, str]
+        b: Union[int, float, str]
 
-def strip_code_fences(text: str) -> str:
-    """Remove Markdown code fences if the model wrapped JSON in ``` blocks."""
-    return _code_fence_pattern.sub("", text).strip()
+    class Plan(msgspec.Struct):
+        steps: List[PlanStep]
 
+    _step_decoder = msgspec.json.Decoder(PlanStep)
+    _plan_decoder = msgspec.json.Decoder(Plan)
+else:
+    _step_decoder = _plan_decoder = None
 
-def coerce_number(x: Any) -> Any:
-    """Coerce numeric-looking strings to int/float. Leaves other types unchanged."""
-    if isinstance(x, (int, float)):
-        return x
-    if isinstance(x, str):
-        try:
-            if "." in x:
-                return float(x)
-            return int(x)
-        except ValueError:
-            return x
-    return x
 
+def _step_from_struct(s: Any) -> ToolCall:
+    return ToolCall(func=s.func, a=s.a, b=s.b)
+
+
+def decode_step(raw: str) -> ToolCall:
+    """Parse and validate the JSON text of one step."""
+    return core.decode_step(raw, _step_decoder, _step_from_struct, ToolCall.from_obj)
 
-def resolve_result_refs(value: Any, prior: Dict[int, Any]) -> Any:
-    """Replace 'RESULT_N' references with the actual numeric output from step N."""
-    if isinstance(value, str) and value.startswith("RESULT_"):
-        try:
-            idx = int(value.split("_", 1)[1])
-            return prior[idx]
-        except Exception:
-            raise ValueError(f"Bad result reference: {value}")
-    return value
+
+def decode_plan(raw: str) -> List[ToolCall]:
+    """Parse and validate a ``{"steps": [...]}`` plan."""
+    return core.decode_plan(raw, _plan_decoder, _step_from_struct, ToolCall.from_obj)
+
+
+MATH_SPEC = core.ToolChainSpec(
+    system_prompt=SYSTEM_PROMPT,
+    response_format=PLAN_RESPONSE_FORMAT,
+    decode_plan=decode_plan,
+    decode_step=decode_step,
+    step_type=ToolCall,
+    # Math tools are deterministic, so results never go stale; bound the size only.
+    new_result_cache=lambda: LRUCache(maxsize=10_000),
+)
 
 # -----------------------------------------------------------------------------
-# LLM planning step
+# Local planning fast path
 # -----------------------------------------------------------------------------
+_arith_candidate_pattern = re.compile(r"[-+*/().\d\s]+")
+_BINOP_FUNCS = {ast.Add: "add", ast.Sub: "subtract", ast.Mult: "multiply", ast.Div: "divide"}
+# Words that change the meaning of the numbers around them; leave those questions to the LLM.
+_math_words_pattern = re.compile(
+    r"\b(?:sqrt|root|squared?|cubed?|power|pow|exp|log|ln|sin|cos|tan|percent|of|mod|modulo|remainder|"
+    r"factorial|average|mean|sum|twice|half|double|triple)\b",
+    re.IGNORECASE,
+)
+
 
-def get_openai_client() -> OpenAI:
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise RuntimeError("OPENAI_API_KEY is not set")
-    return OpenAI(api_key=api_key)
-
-
-def plan_tool_chain(question: str, model: str = DEFAULT_MODEL) -> List[ToolCall]:
-    """Ask the LLM to produce a JSON array of tool calls for the math question."""
-    client = get_openai_client()
-    resp = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": question},
-        ],
-        temperature=0,
-    )
-    raw = resp.choices[0].message.content or ""
-    logging.info("LLM raw response: %s", raw)
-    cleaned = strip_code_fences(raw)
+def try_local_plan(question: str) -> Optional[List[ToolCall]]:
+    """Plan a plain arithmetic question such as 'What is (12 + 8) * 8?' without the LLM.
+
+    The single arithmetic expression in the question is parsed with ``ast`` and each
+    ``BinOp`` becomes one tool call, with nested results passed on as RESULT_N.
+    Returns None when the question is anything else, so the caller falls back to the LLM.
+    """
+    candidates = [m for m in _arith_candidate_pattern.finditer(question) if any(ch.isdigit() for ch in m.group())]
+    if len(candidates) != 1:
+        return None  # no expression, or numbers outside it that the LLM has to interpret
+    m = candidates[0]
+    expr = m.group().strip()
+    start = m.start() + m.group().index(expr)
+    end = start + len(expr)
+    before = question[start - 1] if start > 0 else " "
+    after = question[end] if end < len(question) else " "
+    if before.isalnum() or before == "_" or after.isalnum() or after == "_":
+        return None  # part of a function call or identifier, e.g. sqrt(16)
+    if _math_words_pattern.search(question[:start]) or _math_words_pattern.search(question[end:]):
+        return None
     try:
-        parsed = json.loads(cleaned)
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Could not parse JSON tool chain: {e}\nRaw: {raw}") from e
-    if not isinstance(parsed, list):
-        raise ValueError("Expected a JSON array of tool calls")
+        tree = ast.parse(expr.rstrip("."), mode="eval")  # drop a sentence-ending period
+    except (SyntaxError, RecursionError, MemoryError):  # the latter two: very long or deep expressions
+        return None
 
     steps: List[ToolCall] = []
-    for i, obj in enumerate(parsed, start=1):
-        try:
-            steps.append(ToolCall.from_obj(obj))
-        except Exception as e:
-            raise ValueError(f"Invalid step {i}: {e}") from e
-    if not steps:
-        raise ValueError("No steps generated by the LLM")
-    return steps
+
+    def emit(node: ast.AST) -> Any:
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return node.value
+        if (
+            isinstance(node, ast.UnaryOp)
+            and isinstance(node.op, (ast.UAdd, ast.USub))
+            and isinstance(node.operand, ast.Constant)
+            and type(node.operand.value) in (int, float)
+        ):
+            return -node.operand.value if isinstance(node.op, ast.USub) else node.operand.value
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINOP_FUNCS:
+            a = emit(node.left)
+            b = emit(node.right)
+            steps.append(ToolCall(func=_BINOP_FUNCS[type(node.op)], a=a, b=b))
+            return f"RESULT_{len(steps)}"
+        raise ValueError(f"Unsupported expression node: {type(node).__name__}")
+
+    try:
+        emit(tree.body)
+    except (ValueError, RecursionError):
+        return None
+    return steps or None
 
 # -----------------------------------------------------------------------------
-# MCP execution step
+# Batched execution (one MCP call per plan)
 # -----------------------------------------------------------------------------
-async def execute_chain_via_mcp(steps: List[ToolCall]) -> List[Dict[str, Any]]:
-    """Execute each planned step against the MCP server.
+async def execute_chain_batched(conn: core.McpConnection, steps: List[ToolCall]) -> List[Dict[str, Any]]:
+    """Evaluate the whole plan with the server's ``batch_evaluate`` tool in one round-trip.
 
-    Returns a list of dicts with keys: func, args, output, error (optional).
-    Stops on the first tool error and includes the error in the corresponding step.
+    Returns the same step views as ``core.execute_chain_via_mcp``. If the batch fails (a step
+    errors, or the server has no such tool), the plan is re-run step by step so the failing
+    step is reported on its own.
     """
-    results: List[Dict[str, Any]] = []
-    prior_outputs: Dict[int, Any] = {}
-
-    client = Client(MCP_BASE_URL)
-
-    async with client:
-        for i, step in enumerate(steps, start=1):
-            # Resolve RESULT_N references and coerce numeric strings
-            a = coerce_number(resolve_result_refs(step.a, prior_outputs))
-            b = coerce_number(resolve_result_refs(step.b, prior_outputs))
-
-            step_view = {"func": step.func, "args": {"func": step.func, "a": a, "b": b}}
+    client = await core.ensure_entered(conn)
+    try:
+        result = await core.call_tool_cached(conn, client, "batch_evaluate", {"steps": [asdict(step) for step in steps]})
+    except Exception:
+        logging.info("batch_evaluate failed; running the plan step by step", exc_info=True)
+        result = None
+    outputs = getattr(result, "data", None)
+    if getattr(result, "is_error", True) or not isinstance(outputs, list) or len(outputs) != len(steps):
+        return await core.execute_chain_via_mcp(conn, steps)
 
-            try:
-                result = await client.call_tool(step.func, {"a": a, "b": b}, raise_on_error=False)
-                output = result.data if result.data is not None else "<no output>"
+    prior_outputs = dict(enumerate(outputs, start=1))
+    return [
+        {"step": i, "func": step.func, "args": {"func": step.func, **(core.resolve_args(step.args, prior_outputs) if step.refs else step.args)}, "output": prior_outputs[i]}
+        for i, step in enumerate(steps, start=1)
+    ]
 
-                step_view["output"] = output
-                results.append(step_view)
 
-                if getattr(result, "is_error", False):
-                    # Preserve an error marker and stop executing further steps
-                    step_view["error"] = "Tool error"
-                    break
+# -----------------------------------------------------------------------------
+# Local execution (no network)
+# -----------------------------------------------------------------------------
 
-                # Save output for RESULT_N references in later steps
-                prior_outputs[i] = output
 
-            except Exception as e:  # Network errors, timeouts, etc.
-                step_view["error"] = f"Execution error: {e}"
-                results.append(step_view)
-                break
+def execute_chain_local(steps: List[ToolCall]) -> List[Dict[str, Any]]:
+    """Evaluate the planned steps in-process instead of calling the MCP server.
 
+    Each math tool performs a single floating-point operation, so a network round-trip
+    per step is pure overhead. Returns the same step views as ``core.execute_chain_via_mcp``.
+    """
+    results: List[Dict[str, Any]] = []
+    prior_outputs: Dict[int, Any] = {}
+    for i, step in enumerate(steps, start=1):
+        step_view: Dict[str, Any] = {"step": i, "func": step.func}
+        results.append(step_view)
+        try:
+            a = core.resolve_result_refs(step.a, prior_outputs)
+            b = core.resolve_result_refs(step.b, prior_outputs)
+            step_view["args"] = {"func": step.func, "a": a, "b": b}
+            prior_outputs[i] = step_view["output"] = float(LOCAL_OPS[step.func](a, b))
+        except Exception as e:
+            step_view.setdefault("args", {"func": step.func, "a": step.a, "b": step.b})
+            step_view["error"] = f"Execution error: {e}"
+            break
     return results
 
 # -----------------------------------------------------------------------------
@@ -217,10 +311,16 @@ def main() -> None:
     with st.sidebar:
         st.header("Settings")
         st.caption("These are read at runtime.")
-        st.text_input("MCP base URL", value=MCP_BASE_URL, disabled=True, help="Set MCP_BASE_URL env var to change.")
-        model = st.text_input("OpenAI model", value=DEFAULT_MODEL, help="Any chat-completions-capable model.")
+        st.text_input("MCP base URL", value=core.MCP_BASE_URL, disabled=True, help="Set MCP_BASE_URL env var to change.")
+        model = st.text_input("OpenAI model", value=core.DEFAULT_MODEL, help="Any chat-completions model that supports structured outputs (json_schema).")
+        execute_locally = st.toggle(
+            "Execute locally",
+            value=True,
+            help="Evaluate the planned steps in-process. Turn off to send every step to the MCP server.",
+        )
 
-    st.write("Enter a plain-English math question. The LLM will plan the steps; the MCP tools will compute them.")
+    executor = "they are evaluated in-process" if execute_locally else "the MCP tools will compute them"
+    st.write(f"Enter a plain-English math question. The LLM will plan the steps; {executor}.")
 
     with st.form("solver", clear_on_submit=False):
         question = st.text_input("Math question", placeholder="What is (12 + 8) * 8?")
@@ -229,24 +329,49 @@ def main() -> None:
     if not submitted or not question:
         st.stop()
 
-    with st.status("Planning with LLM…", expanded=False):
-        try:
-            steps = plan_tool_chain(question, model=model)
-        except Exception as e:
-            st.error(str(e))
-            return
-
-    st.subheader("Planned steps (from LLM)")
-    st.json([step.__dict__ for step in steps])
+    steps = try_local_plan(question)
+    planned_locally = steps is not None
+    if steps is None:
+        steps = core.lookup_cached_plan(MATH_SPEC, question, model)
 
-    st.subheader("Executing against MCP tools")
-    with st.status("Calling tools…", expanded=True):
-        run = asyncio.run(execute_chain_via_mcp(steps))
+    run = None
+    if steps is None and execute_locally:
+        with st.status("Planning with LLM…", expanded=False):
+            try:
+                steps = core.plan_tool_chain_cached(MATH_SPEC, question, model=model)
+            except Exception as e:
+                st.error(str(e))
+                return
+    elif steps is None:
+        # Stream the plan and start calling tools while the LLM is still generating.
+        with st.status("Planning with LLM and calling tools…", expanded=True):
+            try:
+                steps, run = core.run_async(core.execute_streamed_chain(
+                    core.get_mcp_client(MATH_SPEC), core.stream_plan_steps(MATH_SPEC, question, model=model),
+                ))
+            except Exception as e:
+                st.error(str(e))
+                return
+        core.store_cached_plan(MATH_SPEC, question, model, steps)
+
+    st.subheader("Planned steps (local parser)" if planned_locally else "Planned steps (from LLM)")
+    core.show_json([asdict(step) for step in steps])
+
+    if execute_locally:
+        st.subheader("Executing locally")
+        run = execute_chain_local(steps)
+    else:
+        st.subheader("Executing against MCP tools")
+        if run is None:
+            # Multi-step plans go to the server in one batch_evaluate call.
+            execute = execute_chain_batched if len(steps) > 1 else core.execute_chain_via_mcp
+            with st.status("Calling tools…", expanded=True):
+                run = core.run_async(execute(core.get_mcp_client(MATH_SPEC), steps))
 
     # Pretty print each step result
     for idx, step in enumerate(run, start=1):
-        st.markdown(f"**Step {idx}:** `{step.get('func', '')}`")
-        st.json(step.get("args", {}))
+        st.markdown(f"**Step {step.get('step', idx)}:** `{step.get('func', '')}`")
+        core.show_json(step.get("args", {}))
         if "output" in step:
             st.success(f"Output: {step['output']}")
         if "error" in step:
@@ -4,18 +4,22 @@ Workshop: LLM + Streamable HTTP MCP (Weather Tools) with Streamlit
 
 This app shows how to:
   1) Ask an LLM to *plan* weather queries as a chain of tool calls
-     (get_current_weather, get_daily_forecast), and
+     (get_current_weather, get_daily_forecast, get_weather_bundle), and
   2) Execute those tool calls against an MCP server that exposes the weather tools over HTTP.
 
 Prerequisites
 -------------
-- Python 3.9+
+- Python 3.11+
 - `pip install streamlit openai fastmcp pandas`
 - A Weather MCP server running locally with tools:
     - get_current_weather(city, country_code?, state?, units?, lang?)
     - get_daily_forecast(city, days, country_code?, state?, units?, lang?)
+    - get_weather_bundle(city, days, country_code?, state?, units?, lang?)
   For example: http://127.0.0.1:8000/mcp
 - An OpenAI API key (set OPENAI_API_KEY in env or Streamlit secrets).
+- Optional: `pip install msgspec orjson` for faster plan parsing and JSON rendering.
+- The LLM planner and MCP executor shared with the other tutorials live in `mcp_ui_core.py`
+  at the repository root; keep this file inside its tutorial folder so it can be found.
 
 Run
 ---
@@ -26,27 +30,38 @@ Run
 Notes
 -----
 - The LLM only *plans* the steps. All data comes from the MCP tools.
-- Output must be a JSON array like:
-  [
-    {"func": "get_current_weather", "city": "Södertälje", "country_code": "SE", "units": "metric"},
-    {"func": "get_daily_forecast", "city": "Södertälje", "country_code": "SE", "days": 5}
-  ]
+- The LLM replies with structured output (a JSON schema enforced by the API) like:
+  {"steps": [
+    {"func": "get_weather_bundle", "city": "Södertälje", "country_code": "SE", "days": 5, "units": "metric"},
+    {"func": "get_current_weather", "city": "Göteborg", "country_code": "SE"}
+  ]}
 - Later steps may reference earlier outputs as RESULT_N (1-based), though this app
   will simply pass the entire referenced object if used.
 """
 from __future__ import annotations
 
-import asyncio
-import json
 import logging
 import os
 import re
+import sys
 from dataclasses import dataclass
-from typing import Any, Dict, List
+from functools import cached_property
+from pathlib import Path
+from typing import Any, Dict, List, Literal, Optional, Tuple
 
 import streamlit as st
-from fastmcp import Client
-from openai import OpenAI
+from cachetools import TTLCache
+
+try:  # optional: parses and validates plans in one C pass
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# The planner/executor shared by all tutorial UIs lives in mcp_ui_core.py at the repo root.
+REPO_ROOT = str(Path(__file__).resolve().parent.parent)
+if REPO_ROOT not in sys.path:  # the script's top level re-runs on every Streamlit rerun
+    sys.path.insert(0, REPO_ROOT)
+import mcp_ui_core as core  # noqa: E402
 
 try:
     import pandas as pd
@@ -56,9 +71,8 @@ except Exception:
 # -----------------------------------------------------------------------------
 # Configuration & constants
 # -----------------------------------------------------------------------------
-ALLOWED_FUNCS = {"get_current_weather", "get_daily_forecast"}
-DEFAULT_MODEL = "gpt-3.5-turbo"  # Any chat-completions-capable model works
-MCP_BASE_URL = os.getenv("MCP_BASE_URL", "http://127.0.0.1:8000/mcp")
+ALLOWED_FUNCS = {"get_current_weather", "get_daily_forecast", "get_weather_bundle"}
+FORECAST_FUNCS = {"get_daily_forecast", "get_weather_bundle"}  # tools that take `days`
 
 DEFAULT_UNITS = os.getenv("WEATHER_DEFAULT_UNITS", "metric")  # metric | imperial
 DEFAULT_LANG = os.getenv("WEATHER_DEFAULT_LANG", "en")
@@ -66,25 +80,69 @@ DEFAULT_FC_DAYS = int(os.getenv("WEATHER_DEFAULT_DAYS", "5"))
 
 SYSTEM_PROMPT = (
     "You are a weather tool-calling assistant. "
-    "Given a user request, output a JSON array of tool calls in execution order. "
+    "Given a user request, list the tool calls in execution order. "
     "Allowed tools:\n"
     " - get_current_weather(city, country_code?, state?, units?, lang?)\n"
     " - get_daily_forecast(city, days, country_code?, state?, units?, lang?)\n"
+    " - get_weather_bundle(city, days, country_code?, state?, units?, lang?)\n"
     "Rules:\n"
-    " - Output ONLY a valid JSON array, no commentary.\n"
-    " - Include parameters using the exact names above.\n"
+    " - Use null for optional parameters the user did not ask for.\n"
     " - If units are not specified by the user, prefer 'metric'.\n"
     " - If language not specified, prefer 'en'.\n"
     " - If user asks for a multi-day outlook, use get_daily_forecast with an integer 'days'.\n"
+    " - If user asks for both current weather and a forecast for the same city, use a single\n"
+    "   get_weather_bundle call instead of two separate calls.\n"
     " - Later steps may refer to prior outputs as RESULT_N (1-based).\n"
     "Examples:\n"
     "Q: What's the weather in Södertälje right now?\n"
-    "[{\"func\":\"get_current_weather\",\"city\":\"Södertälje\",\"country_code\":\"SE\",\"units\":\"metric\"}]\n"
+    "{\"steps\":[{\"func\":\"get_current_weather\",\"city\":\"Södertälje\",\"country_code\":\"SE\",\"units\":\"metric\"}]}\n"
     "Q: Weather in London today and 5-day forecast.\n"
-    "[{\"func\":\"get_current_weather\",\"city\":\"London\",\"country_code\":\"GB\",\"units\":\"metric\"},"
-    " {\"func\":\"get_daily_forecast\",\"city\":\"London\",\"country_code\":\"GB\",\"days\":5,\"units\":\"metric\"}]"
+    "{\"steps\":[{\"func\":\"get_weather_bundle\",\"city\":\"London\",\"country_code\":\"GB\",\"days\":5,\"units\":\"metric\"}]}"
 )
 
+# Structured output schema for the plan, one variant per tool. The API guarantees replies
+# match it, so there is no code-fence stripping; optional parameters arrive as null.
+_LOCATION_PARAMS = {
+    "city": {"type": "string"},
+    "country_code": {"type": ["string", "null"]},
+    "state": {"type": ["string", "null"]},
+    "units": {"anyOf": [{"type": "string", "enum": ["metric", "imperial"]}, {"type": "null"}]},
+    "lang": {"type": ["string", "null"]},
+}
+_TOOL_PARAMS = {
+    "get_current_weather": _LOCATION_PARAMS,
+    "get_daily_forecast": {**_LOCATION_PARAMS, "days": {"type": ["integer", "null"]}},
+    "get_weather_bundle": {**_LOCATION_PARAMS, "days": {"type": ["integer", "null"]}},
+}
+PLAN_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "tool_chain",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "steps": {
+                    "type": "array",
+                    "items": {
+                        "anyOf": [
+                            {
+                                "type": "object",
+                                "properties": {"func": {"type": "string", "enum": [func]}, **params},
+                                "required": ["func", *params],
+                                "additionalProperties": False,
+                            }
+                            for func, params in _TOOL_PARAMS.items()
+                        ],
+                    },
+                },
+            },
+            "required": ["steps"],
+            "additionalProperties": False,
+        },
+    },
+}
+
 # -----------------------------------------------------------------------------
 # Data structures
 # -----------------------------------------------------------------------------
@@ -94,6 +152,11 @@ class ToolCall:
     func: str
     args: Dict[str, Any]
 
+    @cached_property
+    def refs(self) -> List[int]:
+        """Step indices this step references as RESULT_N, computed once per plan step."""
+        return core.find_result_refs(*self.args.values())
+
     @classmethod
     def from_obj(cls, obj: Dict[str, Any]) -> "ToolCall":
         if not isinstance(obj, dict):
@@ -101,120 +164,94 @@ class ToolCall:
         func = obj.get("func")
         if func not in ALLOWED_FUNCS:
             raise ValueError(f"Invalid func '{func}'. Allowed: {sorted(ALLOWED_FUNCS)}")
-        # Copy all remaining keys except 'func' as arguments
-        args = {k: v for k, v in obj.items() if k != "func"}
+        # Copy all remaining keys except 'func' as arguments; null means "not given"
+        args = {k: v for k, v in obj.items() if k != "func" and v is not None}
         return cls(func=func, args=args)
 
+if msgspec is not None:
+    class PlanStep(msgspec.Struct):
+        """Typed view of one plan step; mirrors the items of ``PLAN_RESPONSE_FORMAT``."""
+        func: Literal["get_current_weather", "get_daily_forecast", "get_weather_bundle"]
+        city: str
+        country_code: Optional[str] = None
+        state: Optional[str] = None
+        units: Optional[Literal["metric", "imperial"]] = None
+        lang: Optional[str] = None
+        days: Optional[int] = None
+
+    class Plan(msgspec.Struct):
+        steps: List[PlanStep]
+
+    _step_decoder = msgspec.json.Decoder(PlanStep)
+    _plan_decoder = msgspec.json.Decoder(Plan)
+else:
+    _step_decoder = _plan_decoder = None
+
+def _step_from_struct(s: Any) -> ToolCall:
+    return ToolCall.from_obj(msgspec.structs.asdict(s))
+
+def decode_step(raw: str) -> ToolCall:
+    """Parse and validate the JSON text of one step."""
+    return core.decode_step(raw, _step_decoder, _step_from_struct, ToolCall.from_obj)
+
+def decode_plan(raw: str) -> List[ToolCall]:
+    """Parse and validate a ``{"steps": [...]}`` plan."""
+    return core.decode_plan(raw, _plan_decoder, _step_from_struct, ToolCall.from_obj)
+
+WEATHER_SPEC = core.ToolChainSpec(
+    system_prompt=SYSTEM_PROMPT,
+    response_format=PLAN_RESPONSE_FORMAT,
+    decode_plan=decode_plan,
+    decode_step=decode_step,
+    step_type=ToolCall,
+    # Weather changes slowly; reuse identical lookups for a minute.
+    new_result_cache=lambda: TTLCache(maxsize=1024, ttl=60),
+)
+
 # -----------------------------------------------------------------------------
 # Utilities
 # -----------------------------------------------------------------------------
-_code_fence_pattern = re.compile(r"^```[a-zA-Z0-9]*\n|\n```$", re.MULTILINE)
-
-def strip_code_fences(text: str) -> str:
-    """Remove Markdown code fences if the model wrapped JSON."""
-    return _code_fence_pattern.sub("", text).strip()
-
-def resolve_result_refs(value: Any, prior: Dict[int, Any]) -> Any:
-    """Replace 'RESULT_N' with the actual prior output object."""
-    if isinstance(value, str) and value.startswith("RESULT_"):
-        try:
-            idx = int(value.split("_", 1)[1])
-            return prior[idx]
-        except Exception:
-            raise ValueError(f"Bad result reference: {value}")
-    return value
-
 def apply_defaults(func: str, args: Dict[str, Any], units_default: str, lang_default: str, fc_default_days: int) -> Dict[str, Any]:
-    """Fill in sensible defaults if the LLM omits them."""
+    """Fill in the optional parameters the LLM left out.
+
+    Returns ``args`` itself when nothing is missing; otherwise a copy, so the plan is never mutated.
+    """
+    if "units" in args and "lang" in args and (func not in FORECAST_FUNCS or "days" in args):
+        return args
     out = dict(args)
-    if func in {"get_current_weather", "get_daily_forecast"}:
-        out.setdefault("units", units_default)
-        out.setdefault("lang", lang_default)
-    if func == "get_daily_forecast":
+    out.setdefault("units", units_default)
+    out.setdefault("lang", lang_default)
+    if func in FORECAST_FUNCS:
         out.setdefault("days", fc_default_days)
     return out
 
 # -----------------------------------------------------------------------------
-# LLM planning
+# Local planning fast path
 # -----------------------------------------------------------------------------
-def get_openai_client() -> OpenAI:
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise RuntimeError("OPENAI_API_KEY is not set")
-    return OpenAI(api_key=api_key)
-
-def plan_tool_chain(question: str, model: str = DEFAULT_MODEL) -> List[ToolCall]:
-    """Ask the LLM to produce a JSON array of tool calls for the weather question."""
-    client = get_openai_client()
-    resp = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": question},
-        ],
-        temperature=0,
-    )
-    raw = resp.choices[0].message.content or ""
-    logging.info("LLM raw response: %s", raw)
-    cleaned = strip_code_fences(raw)
-    try:
-        parsed = json.loads(cleaned)
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Could not parse JSON tool chain: {e}\nRaw: {raw}") from e
-    if not isinstance(parsed, list):
-        raise ValueError("Expected a JSON array of tool calls")
-
-    steps: List[ToolCall] = []
-    for i, obj in enumerate(parsed, start=1):
-        try:
-            steps.append(ToolCall.from_obj(obj))
-        except Exception as e:
-            raise ValueError(f"Invalid step {i}: {e}") from e
-    if not steps:
-        raise ValueError("No steps generated by the LLM")
-    return steps
+_weather_now_pattern = re.compile(
+    r"^\s*(?:what(?:'s| is) the\s+)?(?:current\s+)?weather\s+in\s+(?P<city>[^\W\d_][^\W\d_ .'-]*(?:[ .'-]+[^\W\d_]+)*?)"
+    r"(?:\s+(?:right\s+)?now|\s+today)?\s*[?.!]?\s*$",
+    re.IGNORECASE,
+)
+# Words that mean the request needs more than a plain current-weather lookup.
+_not_a_city_pattern = re.compile(
+    r"\b(?:and|or|in|for|with|forecast|tomorrow|week|weekend|days?|hourly|metric|imperial|celsius|fahrenheit|units?|language)\b",
+    re.IGNORECASE,
+)
 
-# -----------------------------------------------------------------------------
-# MCP execution
-# -----------------------------------------------------------------------------
-async def execute_chain_via_mcp(steps: List[ToolCall], units_default: str, lang_default: str, fc_default_days: int) -> List[Dict[str, Any]]:
-    """Execute each planned step against the MCP server.
+def try_local_plan(question: str) -> Optional[List[ToolCall]]:
+    """Plan 'weather in <City>' as a single get_current_weather call without the LLM.
 
-    Returns a list of dicts with keys: func, args, output, error (optional).
-    Stops on the first tool error.
+    Returns None for anything else (forecasts, units, several cities, ...), so the
+    caller falls back to the LLM planner.
     """
-    results: List[Dict[str, Any]] = []
-    prior_outputs: Dict[int, Any] = {}
-
-    client = Client(MCP_BASE_URL)
-
-    async with client:
-        for i, step in enumerate(steps, start=1):
-            # Fill in defaults, then resolve RESULT_N references inside arg values.
-            prepared_args = apply_defaults(step.func, step.args, units_default, lang_default, fc_default_days)
-            for k, v in list(prepared_args.items()):
-                prepared_args[k] = resolve_result_refs(v, prior_outputs)
-
-            step_view = {"func": step.func, "args": {"func": step.func, **prepared_args}}
-
-            try:
-                result = await client.call_tool(step.func, prepared_args, raise_on_error=False)
-                output = result.data if result.data is not None else "<no output>"
-                step_view["output"] = output
-                results.append(step_view)
-
-                if getattr(result, "is_error", False):
-                    step_view["error"] = "Tool error"
-                    break
-
-                prior_outputs[i] = output
-
-            except Exception as e:
-                step_view["error"] = f"Execution error: {e}"
-                results.append(step_view)
-                break
-
-    return results
+    m = _weather_now_pattern.match(question)
+    if not m:
+        return None
+    city = m.group("city").strip()
+    if _not_a_city_pattern.search(city):
+        return None
+    return [ToolCall(func="get_current_weather", args={"city": city})]
 
 # -----------------------------------------------------------------------------
 # Presentation helpers
@@ -232,6 +269,18 @@ def render_current(block: Dict[str, Any]) -> None:
     cols[2].metric("Wind", f"{cur.get('wind_speed','?')} (dir {cur.get('wind_direction','?')}°)")
     st.write(f"**Conditions:** {cur.get('weather_description','Unknown')} • Observed at: {cur.get('observed_at','?')}")
 
+@st.cache_data(show_spinner=False)
+def build_forecast_frames(days: List[Dict[str, Any]]) -> Tuple[Any, Optional[Any]]:
+    """Forecast table and (if possible) temperature chart frames, cached across reruns."""
+    df = pd.DataFrame(days)
+    # Reorder columns if present
+    cols = [c for c in ["date","weather_description","temp_min","temp_max","precipitation_sum","wind_speed_max"] if c in df.columns]
+    chart = None
+    # Optional quick chart if temp columns exist
+    if {"date","temp_min","temp_max"}.issubset(df.columns):
+        chart = df.set_index("date")[["temp_min","temp_max"]]
+    return df[cols], chart
+
 def render_forecast(block: Dict[str, Any]) -> None:
     loc = block.get("location", {}) or {}
     days = block.get("daily", []) or []
@@ -240,28 +289,28 @@ def render_forecast(block: Dict[str, Any]) -> None:
         st.info("No daily forecast data.")
         return
     if pd:
-        df = pd.DataFrame(days)
-        # Reorder columns if present
-        cols = [c for c in ["date","weather_description","temp_min","temp_max","precipitation_sum","wind_speed_max"] if c in df.columns]
-        st.dataframe(df[cols], use_container_width=True)
-        # Optional quick chart if temp columns exist
-        if {"date","temp_min","temp_max"}.issubset(df.columns):
-            st.line_chart(df.set_index("date")[["temp_min","temp_max"]])
+        table, chart = build_forecast_frames(days)
+        st.dataframe(table, use_container_width=True)
+        if chart is not None:
+            st.line_chart(chart)
     else:
-        st.json(days)
+        core.show_json(days)
 
 def pretty_render_step(step: Dict[str, Any]) -> None:
     """Pretty-print a single executed step with custom formatting for known tools."""
     st.markdown(f"**Tool:** `{step.get('func','')}`")
-    st.json(step.get("args", {}))
+    core.show_json(step.get("args", {}))
     if "output" in step:
         out = step["output"]
         if isinstance(out, dict) and step.get("func") == "get_current_weather":
             render_current(out)
         elif isinstance(out, dict) and step.get("func") == "get_daily_forecast":
             render_forecast(out)
+        elif isinstance(out, dict) and step.get("func") == "get_weather_bundle":
+            render_current(out)
+            render_forecast(out)
         else:
-            st.json(out)
+            core.show_json(out)
     if "error" in step:
         st.error(step["error"])
 
@@ -279,8 +328,8 @@ def main() -> None:
     with st.sidebar:
         st.header("Settings")
         st.caption("These are read at runtime.")
-        st.text_input("MCP base URL", value=MCP_BASE_URL, disabled=True, help="Set MCP_BASE_URL env var to change.")
-        model = st.text_input("OpenAI model", value=DEFAULT_MODEL, help="Any chat-completions-capable model.")
+        st.text_input("MCP base URL", value=core.MCP_BASE_URL, disabled=True, help="Set MCP_BASE_URL env var to change.")
+        model = st.text_input("OpenAI model", value=core.DEFAULT_MODEL, help="Any chat-completions model that supports structured outputs (json_schema).")
         st.divider()
         units_default = st.selectbox("Default units", ["metric", "imperial"], index=0 if DEFAULT_UNITS=="metric" else 1)
         lang_default = st.text_input("Default language (IETF code)", value=DEFAULT_LANG)
@@ -295,19 +344,36 @@ def main() -> None:
     if not submitted or not question:
         st.stop()
 
-    with st.status("Planning with LLM…", expanded=False):
-        try:
-            steps = plan_tool_chain(question, model=model)
-        except Exception as e:
-            st.error(str(e))
-            return
+    def defaulted_args(step: ToolCall) -> Dict[str, Any]:
+        return apply_defaults(step.func, step.args, units_default, lang_default, fc_default_days)
+
+    steps = try_local_plan(question)
+    planned_locally = steps is not None
+    if steps is None:
+        steps = core.lookup_cached_plan(WEATHER_SPEC, question, model)
+
+    run = None
+    if steps is None:
+        # Stream the plan and start calling tools while the LLM is still generating.
+        with st.status("Planning with LLM and calling tools…", expanded=True):
+            try:
+                steps, run = core.run_async(core.execute_streamed_chain(
+                    core.get_mcp_client(WEATHER_SPEC), core.stream_plan_steps(WEATHER_SPEC, question, model=model), defaulted_args,
+                ))
+            except Exception as e:
+                st.error(str(e))
+                return
+        core.store_cached_plan(WEATHER_SPEC, question, model, steps)
 
-    st.subheader("Planned steps (from LLM)")
-    st.json([{"func": s.func, **s.args} for s in steps])
+    st.subheader("Planned steps (local parser)" if planned_locally else "Planned steps (from LLM)")
+    core.show_json([{"func": s.func, **s.args} for s in steps])
 
     st.subheader("Executing against MCP tools")
-    with st.status("Calling tools…", expanded=True):
-        run = asyncio.run(execute_chain_via_mcp(steps, units_default, lang_default, fc_default_days))
+    if run is None:
+        with st.status("Calling tools…", expanded=True):
+            # Fill in defaults up front so they are part of the plan's fingerprint.
+            prepared = [ToolCall(func=s.func, args=defaulted_args(s)) for s in steps]
+            run = core.run_async(core.execute_chain_via_mcp(core.get_mcp_client(WEATHER_SPEC), prepared))
 
     for step in run:
         pretty_render_step(step)
@@ -1,12 +1,130 @@
 # weather_mcp_server.py
-import requests
-from typing import Optional, List, Literal, Dict, Any
+import asyncio
+import importlib.util
+from types import MappingProxyType
+from typing import Optional, List, Literal, Dict, Any, Mapping, Tuple
+import httpx
+from cachetools import LRUCache, TTLCache
 from fastmcp import FastMCP
 
-mcp = FastMCP(name="Weather MCP Server", instructions="Provides current weather and simple forecasts by city.")
+try:  # optional: faster parsing of Open-Meteo responses and of tool results on the way out
+    import orjson
+except ImportError:
+    orjson = None
+
+GEOCODE_URL = "https://geocoding-api.open-meteo.com/v1/search"
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+
+# Variables requested from the forecast API, pre-joined into the comma-separated form it expects.
+CURRENT_FIELDS = ",".join([
+    "temperature_2m",
+    "relative_humidity_2m",
+    "is_day",
+    "precipitation",
+    "weather_code",
+    "wind_speed_10m",
+    "wind_direction_10m",
+])
+DAILY_FIELDS = ",".join([
+    "weather_code",
+    "temperature_2m_max",
+    "temperature_2m_min",
+    "precipitation_sum",
+    "wind_speed_10m_max",
+])
+
+# One pooled async client for all Open-Meteo calls, so keep-alive connections (and their TLS
+# handshakes) are reused across tool invocations without blocking the server's event loop.
+# It is created inside the server's loop and lives until the server shuts down (see `_serve`).
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=50)
+# With h2 installed (`pip install "httpx[http2]"`), concurrent requests to an Open-Meteo host
+# are multiplexed over a single TLS connection.
+HTTP2 = importlib.util.find_spec("h2") is not None
+RETRY_STATUSES = (429, 502, 503, 504)  # rate limiting and transient gateway errors
+MAX_RETRIES = 4
+RETRY_BACKOFF = 0.3  # seconds; doubled on each attempt
+MAX_RETRY_WAIT = 10.0  # cap on a server-requested Retry-After
+# No retry starts after this many seconds, so even with a full HTTP_TIMEOUT on the last attempt
+# a tool call answers within the UI's 30 s MCP call timeout.
+RETRY_DEADLINE = 15.0
+CONNECT_RETRIES = 2  # failed TCP/TLS connects, retried by the transport before any response
+_http: Optional[httpx.AsyncClient] = None
+# Requests currently on the wire, so concurrent tool calls for the same place share them.
+_inflight: Dict[Tuple[str, Tuple[Tuple[str, Any], ...]], "asyncio.Future[httpx.Response]"] = {}
+
+# Geocoding results are effectively static, so resolved places are kept for a day. All access
+# happens on the server's event loop, so the cache needs no lock.
+GEOCODE_TTL = 24 * 3600
+_geocode_cache: TTLCache = TTLCache(maxsize=4096, ttl=GEOCODE_TTL)
+
+# Forecast responses, keyed by coordinates rounded to ~1 km. Open-Meteo refreshes current
+# conditions every 15 minutes and daily forecasts far less often.
+CURRENT_TTL = 600
+DAILY_TTL = 3600
+_current_cache: TTLCache = TTLCache(maxsize=1024, ttl=CURRENT_TTL)
+_daily_cache: TTLCache = TTLCache(maxsize=1024, ttl=DAILY_TTL)
+# Result `location` blocks depend only on the geocoded place and its timezone.
+_location_blocks: LRUCache = LRUCache(maxsize=4096)
+
+def _dump_result(data: Any) -> str:
+    return orjson.dumps(data, default=str).decode()
+
+mcp = FastMCP(
+    name="Weather MCP Server",
+    instructions="Provides current weather and simple forecasts by city.",
+    tool_serializer=_dump_result if orjson is not None else None,
+)
 
 # --- Helpers -----------------------------------------------------------------
 
+def _get_http() -> httpx.AsyncClient:
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            headers={"Accept-Encoding": "gzip"},
+            transport=httpx.AsyncHTTPTransport(retries=CONNECT_RETRIES, limits=HTTP_LIMITS, http2=HTTP2),
+        )
+    return _http
+
+def _retry_delay(r: httpx.Response, attempt: int) -> float:
+    retry_after = r.headers.get("Retry-After", "")
+    if retry_after.isdigit():  # the HTTP-date form is rare enough to fall back to backoff
+        return min(float(retry_after), MAX_RETRY_WAIT)
+    return RETRY_BACKOFF * 2 ** attempt
+
+async def _get_with_retries(url: str, params: Dict[str, Any]) -> httpx.Response:
+    """GET through the shared client, retrying rate-limit and gateway errors on the open connection.
+
+    Waits for the server's ``Retry-After`` when it sends one, otherwise backs off exponentially,
+    and gives up with the last response once another wait would pass ``RETRY_DEADLINE``.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + RETRY_DEADLINE
+    for attempt in range(MAX_RETRIES):
+        r = await _get_http().get(url, params=params)
+        if r.status_code not in RETRY_STATUSES:
+            return r
+        delay = _retry_delay(r, attempt)
+        if loop.time() + delay >= deadline:
+            return r
+        await asyncio.sleep(delay)
+    return await _get_http().get(url, params=params)  # last attempt, whatever its status
+
+async def _http_get(url: str, params: Dict[str, Any]) -> httpx.Response:
+    """GET with retries; concurrent identical requests (same URL and params) share one response."""
+    key = (url, tuple(sorted(params.items())))
+    task = _inflight.get(key)
+    if task is None:
+        task = _inflight[key] = asyncio.ensure_future(_get_with_retries(url, params))
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # Shielded so one caller giving up does not cancel the request for the others.
+    return await asyncio.shield(task)
+
+def _json(r: httpx.Response) -> Any:
+    return orjson.loads(r.content) if orjson is not None else r.json()
+
 WEATHER_CODE_MAP = {
     0: "Clear sky",
     1: "Mainly clear", 2: "Partly cloudy", 3: "Overcast",
@@ -22,170 +140,306 @@ WEATHER_CODE_MAP = {
     95: "Thunderstorm", 96: "Thunderstorm with slight hail", 99: "Thunderstorm with heavy hail",
 }
 
-def _choose_match(results: List[Dict[str, Any]], country_code: Optional[str], state: Optional[str]) -> Dict[str, Any]:
-    """Pick the best geocoding match, optionally filtering by country/state."""
+# Dense lookup table over the WMO code range (0-99); gaps read "Unknown".
+_WEATHER_DESCRIPTIONS = tuple(WEATHER_CODE_MAP.get(code, "Unknown") for code in range(100))
+
+def _describe(code: Optional[int]) -> str:
+    return _WEATHER_DESCRIPTIONS[code] if code is not None and 0 <= code < 100 else "Unknown"
+
+def _geocode_key(name: str, country_code: Optional[str], state: Optional[str], lang: str) -> Tuple[str, str, str, str]:
+    """Normalized (name, country_code, state, lang) tuple; empty strings stand for "no filter"."""
+    return (name.strip().casefold(), (country_code or "").strip().upper(), (state or "").strip().casefold(), lang or "en")
+
+def _choose_match(results: List[Dict[str, Any]], cc: str, state: str) -> Dict[str, Any]:
+    """Pick the best geocoding match, optionally filtering by the normalized country/state from `_geocode_key`."""
     if not results:
         raise ValueError("No matching locations found.")
     filtered = results
-    if country_code:
-        cc = country_code.strip().upper()
-        filtered = [r for r in filtered if r.get("country_code", "").upper() == cc] or filtered
+    if cc:
+        filtered = [r for r in filtered if (r.get("country_code") or "").upper() == cc] or filtered
     if state:
-        s = state.lower().strip()
-        filtered = [r for r in filtered if (r.get("admin1") or "").lower() == s] or filtered
+        filtered = [r for r in filtered if (r.get("admin1") or "").casefold() == state] or filtered
     # Prefer largest population if multiple remain
-    filtered.sort(key=lambda r: r.get("population", 0), reverse=True)
-    return filtered[0]
+    return max(filtered, key=lambda r: r.get("population") or 0)
 
-def _geocode_city(name: str, country_code: Optional[str], state: Optional[str], lang: str) -> Dict[str, Any]:
-    url = "https://geocoding-api.open-meteo.com/v1/search"
-    params = {"name": name, "count": 10, "language": lang or "en", "format": "json"}
-    r = requests.get(url, params=params, timeout=10)
+async def _geocode_city(name: str, country_code: Optional[str], state: Optional[str], lang: str) -> Dict[str, Any]:
+    key = _geocode_key(name, country_code, state, lang)
+    _, cc, state_key, _ = key
+    loc = _geocode_cache.get(key)
+    if loc is not None:
+        return loc
+    # Filters need a wider candidate list; otherwise only the most populous of the top hits is used.
+    count = 10 if cc or state_key else 5
+    params: Dict[str, Any] = {"name": name, "count": count, "language": lang or "en", "format": "json"}
+    r = await _http_get(GEOCODE_URL, params)
     if r.status_code != 200:
         raise RuntimeError(f"Geocoding failed: HTTP {r.status_code}")
-    data = r.json()
-    return _choose_match(data.get("results", []), country_code, state)
+    data = _json(r)
+    loc = _geocode_cache[key] = _choose_match(data.get("results", []), cc, state_key)
+    return loc
+
+# Open-Meteo unit parameters per `units` value; read-only so every request can share them.
+_UNITS: Dict[str, Mapping[str, str]] = {
+    "metric": MappingProxyType({"temperature_unit": "celsius", "wind_speed_unit": "ms", "precipitation_unit": "mm"}),
+    "imperial": MappingProxyType({"temperature_unit": "fahrenheit", "wind_speed_unit": "mph", "precipitation_unit": "inch"}),
+}
+
+def _check_days(days: int) -> None:
+    if days < 1 or days > 16:
+        raise ValueError("days must be between 1 and 16 (Open-Meteo limit).")
+
+def _location_block(loc: Dict[str, Any], timezone: Optional[str]) -> Dict[str, Any]:
+    """The result's ``location`` block, built once per geocoded place and timezone and then shared."""
+    key = (loc.get("id"), loc["latitude"], loc["longitude"], timezone)
+    block = _location_blocks.get(key)
+    if block is None:
+        block = _location_blocks[key] = {
+            "name": loc.get("name"),
+            "country": loc.get("country"),
+            "country_code": loc.get("country_code"),
+            "admin1": loc.get("admin1"),
+            "latitude": loc["latitude"],
+            "longitude": loc["longitude"],
+            "timezone": timezone,
+        }
+    return block
+
+def _round(x: Optional[float], ndigits: int) -> Optional[float]:
+    """Rounding keeps results short. Precipitation uses two decimals so light rain in inches stays nonzero."""
+    return round(x, ndigits) if x is not None else None
+
+def _current_block(data: Dict[str, Any], units: Literal["metric", "imperial"]) -> Dict[str, Any]:
+    cur: Dict[str, Any] = data.get("current") or {}
+    raw_code, is_day = cur.get("weather_code"), cur.get("is_day")
+    code = int(raw_code) if raw_code is not None else None
+    return {
+        "observed_at": cur.get("time"),
+        "temperature": _round(cur.get("temperature_2m"), 1),
+        "temperature_unit": "°F" if units == "imperial" else "°C",
+        "relative_humidity": cur.get("relative_humidity_2m"),
+        "precipitation": _round(cur.get("precipitation"), 2),
+        "wind_speed": _round(cur.get("wind_speed_10m"), 1),
+        "wind_direction": cur.get("wind_direction_10m"),
+        "is_day": bool(is_day) if is_day is not None else None,
+        "weather_code": code,
+        "weather_description": _describe(code),
+    }
+
+def _daily_block(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    daily: Dict[str, Any] = data.get("daily") or {}
+    times: List[str] = daily.get("time", []) or []
+    missing = [None] * len(times)
+    columns = zip(
+        times,
+        daily.get("weather_code") or missing,
+        daily.get("temperature_2m_min") or missing,
+        daily.get("temperature_2m_max") or missing,
+        daily.get("precipitation_sum") or missing,
+        daily.get("wind_speed_10m_max") or missing,
+    )
+    out: List[Dict[str, Any]] = []
+    for date, code, tmin, tmax, psum, wmax in columns:
+        code = int(code) if code is not None else None
+        out.append({
+            "date": date,
+            "weather_code": code,
+            "weather_description": _describe(code),
+            "temp_min": _round(tmin, 1),
+            "temp_max": _round(tmax, 1),
+            "precipitation_sum": _round(psum, 2),
+            "wind_speed_max": _round(wmax, 1),
+        })
+    return out
+
+# The fetchers reshape each response right away and cache only the result, so the raw Open-Meteo
+# payload is dropped as soon as it is parsed and cache hits skip the reshaping too.
+
+async def _fetch_current(lat: float, lon: float, units: Literal["metric", "imperial"]) -> Dict[str, Any]:
+    """``{"timezone": ..., "current": {...}}`` for the given coordinates."""
+    key = (round(lat, 2), round(lon, 2), units)
+    data = _current_cache.get(key)
+    if data is not None:
+        return data
+    params: Dict[str, Any] = {
+        "latitude": lat,
+        "longitude": lon,
+        "current": CURRENT_FIELDS,
+        "timezone": "auto",
+        **_UNITS[units],
+    }
+    r = await _http_get(FORECAST_URL, params)
+    if r.status_code != 200:
+        raise RuntimeError(f"Weather fetch failed: HTTP {r.status_code}")
+    data = _json(r)
+    shaped = _current_cache[key] = {"timezone": data.get("timezone"), "current": _current_block(data, units)}
+    return shaped
 
-def _units_params(units: Literal["metric", "imperial"]) -> Dict[str, str]:
-    if units == "imperial":
-        return {"temperature_unit": "fahrenheit", "wind_speed_unit": "mph", "precipitation_unit": "inch"}
-    return {"temperature_unit": "celsius", "wind_speed_unit": "ms", "precipitation_unit": "mm"}
+async def _fetch_daily(lat: float, lon: float, days: int, units: Literal["metric", "imperial"]) -> Dict[str, Any]:
+    """``{"timezone": ..., "daily": [...]}`` for the given coordinates."""
+    key = (round(lat, 2), round(lon, 2), units, days)
+    data = _daily_cache.get(key)
+    if data is not None:
+        return data
+    params: Dict[str, Any] = {
+        "latitude": lat,
+        "longitude": lon,
+        "daily": DAILY_FIELDS,
+        "forecast_days": days,
+        "timezone": "auto",
+        **_UNITS[units],
+    }
+    r = await _http_get(FORECAST_URL, params)
+    if r.status_code != 200:
+        raise RuntimeError(f"Forecast fetch failed: HTTP {r.status_code}")
+    data = _json(r)
+    shaped = _daily_cache[key] = {"timezone": data.get("timezone"), "daily": _daily_block(data)}
+    return shaped
+
+def _compact(loc: Dict[str, Any], timezone: Optional[str], units: Literal["metric", "imperial"],
+             current: Optional[Dict[str, Any]] = None, daily: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """Single-level, short-keyed form of a tool result; daily values become per-field columns."""
+    out = {
+        "name": loc.get("name"),
+        "a1": loc.get("admin1"),
+        "co": loc.get("country"),
+        "cc": loc.get("country_code"),
+        "lat": loc["latitude"],
+        "lon": loc["longitude"],
+        "tz": timezone,
+        "u": units,
+    }
+    if current is not None:
+        out.update({
+            "time": current["observed_at"],
+            "t": current["temperature"],
+            "tu": current["temperature_unit"],
+            "rh": current["relative_humidity"],
+            "p": current["precipitation"],
+            "ws": current["wind_speed"],
+            "wd": current["wind_direction"],
+            "day": current["is_day"],
+            "code": current["weather_code"],
+            "desc": current["weather_description"],
+        })
+    if daily is not None:
+        out.update({
+            "dates": [d["date"] for d in daily],
+            "codes": [d["weather_code"] for d in daily],
+            "tmin": [d["temp_min"] for d in daily],
+            "tmax": [d["temp_max"] for d in daily],
+            "psum": [d["precipitation_sum"] for d in daily],
+            "wsmax": [d["wind_speed_max"] for d in daily],
+        })
+    return out
 
 # --- Tools -------------------------------------------------------------------
 
 @mcp.tool()
-def get_current_weather(
+async def get_current_weather(
     city: str,
     country_code: Optional[str] = None,
     state: Optional[str] = None,
     units: Literal["metric", "imperial"] = "metric",
     lang: str = "en",
+    compact: bool = False,
 ) -> dict:
     """
     Get current weather for a city. Optionally disambiguate with country_code (e.g., 'SE', 'US')
-    and state/region name. Units: 'metric' or 'imperial'.
+    and state/region name. Units: 'metric' or 'imperial'. `compact=True` returns a flat dict with
+    short keys and no `source`, for callers that parse the result themselves.
     """
-    loc = _geocode_city(city, country_code, state, lang)
-    lat, lon = loc["latitude"], loc["longitude"]
-
-    url = "https://api.open-meteo.com/v1/forecast"
-    params = {
-        "latitude": lat,
-        "longitude": lon,
-        "current": ",".join([
-            "temperature_2m",
-            "relative_humidity_2m",
-            "is_day",
-            "precipitation",
-            "weather_code",
-            "wind_speed_10m",
-            "wind_direction_10m",
-        ]),
-        "timezone": "auto",
-        **_units_params(units),
+    loc = await _geocode_city(city, country_code, state, lang)
+    data = await _fetch_current(loc["latitude"], loc["longitude"], units)
+    if compact:
+        return _compact(loc, data["timezone"], units, current=data["current"])
+    return {
+        "location": _location_block(loc, data["timezone"]),
+        "current": data["current"],
+        "units": units,
+        "source": "Open-Meteo",
     }
-    r = requests.get(url, params=params, timeout=10)
-    if r.status_code != 200:
-        raise RuntimeError(f"Weather fetch failed: HTTP {r.status_code}")
-    data = r.json()
-    cur = data.get("current") or {}
-    code = int(cur.get("weather_code")) if cur.get("weather_code") is not None else None
 
+@mcp.tool()
+async def get_daily_forecast(
+    city: str,
+    days: int = 3,
+    country_code: Optional[str] = None,
+    state: Optional[str] = None,
+    units: Literal["metric", "imperial"] = "metric",
+    lang: str = "en",
+    compact: bool = False,
+) -> dict:
+    """
+    Get a simple daily forecast for the next `days` (1–7 recommended). `compact=True` returns a
+    flat dict with one short-keyed list per daily field.
+    """
+    _check_days(days)
+    loc = await _geocode_city(city, country_code, state, lang)
+    data = await _fetch_daily(loc["latitude"], loc["longitude"], days, units)
+    if compact:
+        return _compact(loc, data["timezone"], units, daily=data["daily"])
     return {
-        "location": {
-            "name": loc.get("name"),
-            "country": loc.get("country"),
-            "country_code": loc.get("country_code"),
-            "admin1": loc.get("admin1"),
-            "latitude": lat,
-            "longitude": lon,
-            "timezone": data.get("timezone"),
-        },
-        "current": {
-            "observed_at": cur.get("time"),
-            "temperature": cur.get("temperature_2m"),
-            "temperature_unit": "°F" if units == "imperial" else "°C",
-            "relative_humidity": cur.get("relative_humidity_2m"),
-            "precipitation": cur.get("precipitation"),
-            "wind_speed": cur.get("wind_speed_10m"),
-            "wind_direction": cur.get("wind_direction_10m"),
-            "is_day": bool(cur.get("is_day")) if cur.get("is_day") is not None else None,
-            "weather_code": code,
-            "weather_description": WEATHER_CODE_MAP.get(code, "Unknown"),
-        },
+        "location": _location_block(loc, data["timezone"]),
+        "daily": data["daily"],
         "units": units,
         "source": "Open-Meteo",
     }
 
 @mcp.tool()
-def get_daily_forecast(
+async def get_weather_bundle(
     city: str,
     days: int = 3,
     country_code: Optional[str] = None,
     state: Optional[str] = None,
     units: Literal["metric", "imperial"] = "metric",
     lang: str = "en",
+    compact: bool = False,
 ) -> dict:
     """
-    Get a simple daily forecast for the next `days` (1–7 recommended).
+    Get current weather and a daily forecast for the next `days` in one call. The city is
+    geocoded once and both are fetched concurrently. `compact=True` works as for the other tools.
     """
-    if days < 1 or days > 16:
-        raise ValueError("days must be between 1 and 16 (Open-Meteo limit).")
-
-    loc = _geocode_city(city, country_code, state, lang)
+    _check_days(days)
+    loc = await _geocode_city(city, country_code, state, lang)
     lat, lon = loc["latitude"], loc["longitude"]
-
-    url = "https://api.open-meteo.com/v1/forecast"
-    params = {
-        "latitude": lat,
-        "longitude": lon,
-        "daily": ",".join([
-            "weather_code",
-            "temperature_2m_max",
-            "temperature_2m_min",
-            "precipitation_sum",
-            "wind_speed_10m_max",
-        ]),
-        "forecast_days": days,
-        "timezone": "auto",
-        **_units_params(units),
-    }
-    r = requests.get(url, params=params, timeout=10)
-    if r.status_code != 200:
-        raise RuntimeError(f"Forecast fetch failed: HTTP {r.status_code}")
-    data = r.json()
-    daily = data.get("daily") or {}
-    out = []
-    times = daily.get("time", []) or []
-    for i, date in enumerate(times):
-        code = int(daily["weather_code"][i]) if daily.get("weather_code") else None
-        out.append({
-            "date": date,
-            "weather_code": code,
-            "weather_description": WEATHER_CODE_MAP.get(code, "Unknown"),
-            "temp_min": daily.get("temperature_2m_min", [None]*len(times))[i],
-            "temp_max": daily.get("temperature_2m_max", [None]*len(times))[i],
-            "precipitation_sum": daily.get("precipitation_sum", [None]*len(times))[i],
-            "wind_speed_max": daily.get("wind_speed_10m_max", [None]*len(times))[i],
-        })
-
+    current, daily = await asyncio.gather(_fetch_current(lat, lon, units), _fetch_daily(lat, lon, days, units))
+    if compact:
+        return _compact(loc, current["timezone"], units, current=current["current"], daily=daily["daily"])
     return {
-        "location": {
-            "name": loc.get("name"),
-            "country": loc.get("country"),
-            "country_code": loc.get("country_code"),
-            "admin1": loc.get("admin1"),
-            "latitude": lat,
-            "longitude": lon,
-            "timezone": data.get("timezone"),
-        },
-        "daily": out,
+        "location": _location_block(loc, current["timezone"]),
+        "current": current["current"],
+        "daily": daily["daily"],
         "units": units,
         "source": "Open-Meteo",
     }
 
 # --- Server entrypoint -------------------------------------------------------
 
+# Cheap requests that open a keep-alive connection to each Open-Meteo host.
+WARMUP_REQUESTS: Tuple[Tuple[str, Dict[str, Any]], ...] = (
+    (GEOCODE_URL, {"name": "Berlin", "count": 1}),
+    (FORECAST_URL, {"latitude": 0, "longitude": 0, "current": "temperature_2m"}),
+)
+
+async def _warm_up() -> None:
+    """Pre-connect the pool so the first tool call skips the TCP/TLS handshakes; failures are ignored."""
+    client = _get_http()
+    await asyncio.gather(*(client.get(url, params=params, timeout=2.0) for url, params in WARMUP_REQUESTS),
+                         return_exceptions=True)
+
+async def _serve() -> None:
+    # FastMCP runs a server `lifespan` once per MCP session over HTTP, so the shared client is
+    # owned here instead, for the lifetime of the process.
+    global _http
+    warm_up = asyncio.create_task(_warm_up())
+    try:
+        # Run the server over HTTP transport with streaming support
+        await mcp.run_async(transport="streamable-http", host="0.0.0.0", port=8000)
+    finally:
+        warm_up.cancel()
+        if _http is not None:
+            await _http.aclose()
+            _http = None
+
 if __name__ == "__main__":
-    # Run the server over HTTP transport with streaming support
-    mcp.run(transport="streamable-http", host="0.0.0.0", port=8000)
+    asyncio.run(_serve())
@@ -0,0 +1,803 @@
+"""
+Shared core for the tutorial Streamlit UIs (LLM planner + Streamable HTTP MCP executor)
+=======================================================================================
+
+Both ``1_tutorial/ui.py`` (math) and ``2_tutorial/ui.py`` (weather) follow the same flow:
+ask an LLM to *plan* a chain of tool calls, then execute that chain against an MCP server.
+Everything that does not depend on the tools lives here; each UI only supplies a
+``ToolChainSpec`` (prompt, output schema, step decoding, result cache) and its own rendering.
+
+Plan steps are the UI's own dataclass. The core relies on three attributes only:
+``func`` (tool name), ``args`` (dict of tool arguments, values may be ``RESULT_N``)
+and ``refs`` (the step indices referenced as ``RESULT_N``).
+"""
+from __future__ import annotations
+
+import asyncio
+import atexit
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Coroutine, Dict, List, MutableMapping, Optional, Set, Tuple, TypeVar
+
+import anyio
+import httpx
+import streamlit as st
+from fastmcp import Client
+from fastmcp.client.transports import StreamableHttpTransport
+from mcp.shared.exceptions import McpError
+from openai import AsyncOpenAI, OpenAI
+
+try:  # optional: faster serialization of st.json payloads
+    import orjson
+except ImportError:
+    orjson = None
+
+try:  # optional: typed plan decoding (the UIs pass their msgspec decoders in)
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# -----------------------------------------------------------------------------
+# Configuration & constants
+# -----------------------------------------------------------------------------
+DEFAULT_MODEL = "gpt-4o-mini"  # Any chat-completions model that supports structured outputs
+MCP_BASE_URL = os.getenv("MCP_BASE_URL", "http://127.0.0.1:8000/mcp")
+# Keep idle sockets to the MCP server warm between chains.
+MCP_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0)
+# Concurrent call_tool requests are separate POSTs correlated by JSON-RPC id; over HTTP/2
+# (https endpoints, `pip install h2`) they share one multiplexed connection.
+MCP_HTTP2 = importlib.util.find_spec("h2") is not None
+# A session whose server restarted can leave calls waiting forever, so every wait is bounded.
+MCP_CONNECT_TIMEOUT = 10.0
+MCP_CALL_TIMEOUT = 30.0
+# How long a server's tool listing is reused by new MCP sessions (see ``_seed_tool_schemas``).
+TOOL_SCHEMA_TTL = 300.0
+
+
+@dataclass(frozen=True)
+class ToolChainSpec:
+    """What a UI plugs into the shared planner and executor."""
+    system_prompt: str
+    response_format: Dict[str, Any]  # structured-output schema of the {"steps": [...]} plan
+    decode_plan: Callable[[str], List[Any]]  # JSON text of a whole plan -> steps
+    decode_step: Callable[[str], Any]  # JSON text of one step -> step
+    step_type: Callable[..., Any]  # rebuilds a step from ``asdict(step)`` (plan cache)
+    new_result_cache: Callable[[], MutableMapping[Any, asyncio.Future]]  # per-connection tool results
+
+
+# -----------------------------------------------------------------------------
+# Utilities
+# -----------------------------------------------------------------------------
+_result_ref_pattern = re.compile(r"RESULT_([0-9]+)")
+
+
+def resolve_result_refs(value: Any, prior: Dict[int, Any]) -> Any:
+    """Replace 'RESULT_N' references with the actual output of step N."""
+    if isinstance(value, str):
+        m = _result_ref_pattern.fullmatch(value)
+        if m:
+            try:
+                return prior[int(m[1])]
+            except KeyError:
+                raise ValueError(f"Bad result reference: {value}") from None
+    return value
+
+
+def resolve_args(args: Dict[str, Any], prior_outputs: Dict[int, Any]) -> Dict[str, Any]:
+    """Resolve RESULT_N references in arg values; callers skip steps whose ``refs`` is empty."""
+    return {k: resolve_result_refs(v, prior_outputs) for k, v in args.items()}
+
+
+def find_result_refs(*values: Any) -> List[int]:
+    """Return the step indices referenced as 'RESULT_N' among the given values."""
+    refs: List[int] = []
+    for value in values:
+        if isinstance(value, str):
+            m = _result_ref_pattern.fullmatch(value)
+            if m:
+                refs.append(int(m[1]))
+    return refs
+
+
+def topo_levels(steps: List[Any]) -> List[List[int]]:
+    """Group 1-based step indices into wavefronts that only depend on earlier wavefronts.
+
+    Steps in the same wavefront do not reference each other's RESULT_N and can run concurrently.
+    """
+    depth: Dict[int, int] = {}
+    levels: List[List[int]] = []
+    for i, step in enumerate(steps, start=1):
+        d = max((depth[r] + 1 for r in step.refs if r in depth), default=0)
+        depth[i] = d
+        if d == len(levels):
+            levels.append([])
+        levels[d].append(i)
+    return levels
+
+
+class JsonArrayScanner:
+    """Incrementally extract the elements of a JSON array of objects from streamed text.
+
+    ``item_depth`` is the bracket depth at which the elements open: 2 for a top-level
+    array, 3 for an array held in a top-level object such as ``{"steps": [...]}``.
+    ``feed`` returns the source text of every element completed by the new chunk.
+    """
+
+    def __init__(self, item_depth: int = 2) -> None:
+        self.item_depth = item_depth
+        self.text = ""
+        self._pos = 0
+        self._depth = 0
+        self._start = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str) -> List[str]:
+        self.text += chunk
+        items: List[str] = []
+        for pos in range(self._pos, len(self.text)):
+            ch = self.text[pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "[{":
+                self._depth += 1
+                if self._depth == self.item_depth:
+                    self._start = pos
+            elif ch in "]}":
+                self._depth -= 1
+                if self._depth == self.item_depth - 1:
+                    items.append(self.text[self._start:pos + 1])
+        self._pos = len(self.text)
+        return items
+
+
+# -----------------------------------------------------------------------------
+# Plan decoding
+# -----------------------------------------------------------------------------
+def decode_step(raw: str, step_decoder: Any, to_step: Callable[[Any], Any], from_obj: Callable[[Any], Any]) -> Any:
+    """Parse and validate the JSON text of one step.
+
+    ``step_decoder`` is the UI's ``msgspec.json.Decoder`` for a step (None without msgspec);
+    ``to_step`` turns a decoded struct into a step and ``from_obj`` does the same for a plain dict.
+    """
+    if step_decoder is None:
+        return from_obj(json.loads(raw))
+    try:
+        decoded = step_decoder.decode(raw)
+    except msgspec.MsgspecError as e:
+        raise ValueError(str(e)) from e
+    return to_step(decoded)
+
+
+def decode_plan(raw: str, plan_decoder: Any, to_step: Callable[[Any], Any], from_obj: Callable[[Any], Any]) -> List[Any]:
+    """Parse and validate a ``{"steps": [...]}`` plan; see ``decode_step`` for the arguments."""
+    if plan_decoder is not None:
+        try:
+            plan = plan_decoder.decode(raw)
+        except msgspec.MsgspecError as e:
+            raise ValueError(str(e)) from e
+        return [to_step(s) for s in plan.steps]
+
+    try:
+        parsed = json.loads(raw)["steps"]
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Missing steps: {e}") from e
+    steps: List[Any] = []
+    for i, obj in enumerate(parsed, start=1):
+        try:
+            steps.append(from_obj(obj))
+        except ValueError as e:
+            raise ValueError(f"Invalid step {i}: {e}") from e
+    return steps
+
+
+# -----------------------------------------------------------------------------
+# LLM planning step
+# -----------------------------------------------------------------------------
+def get_openai_client() -> OpenAI:
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise RuntimeError("OPENAI_API_KEY is not set")
+    return _openai_client(api_key)
+
+
+@st.cache_resource(show_spinner=False)
+def _openai_client(api_key: str) -> OpenAI:
+    """One client (and connection pool) per key, reused by every plan in the process."""
+    return OpenAI(api_key=api_key)
+
+
+def plan_tool_chain(spec: ToolChainSpec, question: str, model: str = DEFAULT_MODEL) -> List[Any]:
+    """Ask the LLM to produce a chain of tool calls for the question."""
+    client = get_openai_client()
+    resp = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": spec.system_prompt},
+            {"role": "user", "content": question},
+        ],
+        temperature=0,
+        response_format=spec.response_format,
+    )
+    raw = resp.choices[0].message.content or ""
+    logging.info("LLM raw response: %s", raw)
+    try:
+        steps = spec.decode_plan(raw)
+    except ValueError as e:
+        raise ValueError(f"Could not parse JSON tool chain: {e}\nRaw: {raw}") from e
+    if not steps:
+        raise ValueError("No steps generated by the LLM")
+    return steps
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise RuntimeError("OPENAI_API_KEY is not set")
+    return _async_openai_client(api_key)
+
+
+@st.cache_resource(show_spinner=False)
+def _async_openai_client(api_key: str) -> AsyncOpenAI:
+    """Like ``_openai_client``; its pool lives on the background loop (see ``get_event_loop``)."""
+    return AsyncOpenAI(api_key=api_key)
+
+
+async def stream_plan_steps(spec: ToolChainSpec, question: str, model: str = DEFAULT_MODEL) -> AsyncIterator[Any]:
+    """Stream the LLM plan and yield each step as soon as its JSON object is complete."""
+    client = get_async_openai_client()
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": spec.system_prompt},
+            {"role": "user", "content": question},
+        ],
+        temperature=0,
+        response_format=spec.response_format,
+        stream=True,
+    )
+    scanner = JsonArrayScanner(item_depth=3)  # {"steps": [{...}, ...]}
+    count = 0
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        for item in scanner.feed(chunk.choices[0].delta.content or ""):
+            count += 1
+            try:
+                step = spec.decode_step(item)
+            except ValueError as e:
+                raise ValueError(f"Invalid step {count}: {e}\nRaw: {scanner.text}") from e
+            yield step
+    logging.info("LLM raw response: %s", scanner.text)
+    if not count:
+        raise ValueError(f"No steps generated by the LLM\nRaw: {scanner.text}")
+
+
+def plan_cache_key(spec: ToolChainSpec, question: str, model: str) -> str:
+    """Exact-match key for a plan: same model, prompt and question give the same plan at T=0."""
+    return hashlib.blake2b((model + "\0" + spec.system_prompt + "\0" + question.strip()).encode(), digest_size=16).hexdigest()
+
+
+def lookup_cached_plan(spec: ToolChainSpec, question: str, model: str) -> Optional[List[Any]]:
+    """Return the plan previously stored for this question and model, if any."""
+    hit = st.session_state.get("plan_cache", {}).get(plan_cache_key(spec, question, model))
+    if hit is None:
+        return None
+    return [spec.step_type(**obj) for obj in json.loads(hit)]
+
+
+def store_cached_plan(spec: ToolChainSpec, question: str, model: str, steps: List[Any]) -> None:
+    if "plan_cache" not in st.session_state:
+        st.session_state.plan_cache = {}
+    st.session_state.plan_cache[plan_cache_key(spec, question, model)] = json.dumps([asdict(step) for step in steps])
+
+
+def plan_tool_chain_cached(spec: ToolChainSpec, question: str, model: str = DEFAULT_MODEL) -> List[Any]:
+    """Like ``plan_tool_chain``, but repeated questions are answered from ``st.session_state``."""
+    steps = lookup_cached_plan(spec, question, model)
+    if steps is None:
+        steps = plan_tool_chain(spec, question, model=model)
+        store_cached_plan(spec, question, model, steps)
+    return steps
+
+
+# -----------------------------------------------------------------------------
+# Background event loop (one per process)
+# -----------------------------------------------------------------------------
+T = TypeVar("T")
+
+
+@st.cache_resource(show_spinner=False)
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Return the process-wide background event loop, starting its thread on first use.
+
+    Streamlit reruns the script on every interaction; keeping a single loop alive lets
+    the MCP sessions and their connection pools outlive each run. All browser sessions
+    share it, so the number of loop threads does not grow with the number of visitors.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="mcp-event-loop", daemon=True).start()
+    return loop
+
+
+def run_async(coro: Coroutine[Any, Any, T]) -> T:
+    """Run ``coro`` on the background loop and block until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+
+# -----------------------------------------------------------------------------
+# MCP connection (one persistent session per server, shared by all browser sessions)
+# -----------------------------------------------------------------------------
+@dataclass
+class McpConnection:
+    """A fastmcp client, the event loop its session was opened on, and a tool-result cache."""
+    url: str
+    headers: Dict[str, str]
+    client: Client
+    results: MutableMapping[Any, asyncio.Future]
+    loop: Optional[asyncio.AbstractEventLoop] = None
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)  # serializes (re)connecting
+
+
+def _pooled_httpx_client(
+    headers: Optional[Dict[str, str]] = None,
+    timeout: Optional[httpx.Timeout] = None,
+    auth: Optional[httpx.Auth] = None,
+) -> httpx.AsyncClient:
+    """httpx factory for the MCP transport that keeps connections alive between calls."""
+    return httpx.AsyncClient(headers=headers, timeout=timeout, auth=auth, follow_redirects=True, limits=MCP_HTTP_LIMITS, http2=MCP_HTTP2)
+
+
+def _new_mcp_client(url: str, headers: Dict[str, str]) -> Client:
+    transport = StreamableHttpTransport(url, headers=headers or None, httpx_client_factory=_pooled_httpx_client)
+    return Client(transport)
+
+
+@st.cache_resource(show_spinner=False)
+def _mcp_connections() -> Tuple[threading.Lock, Dict[Tuple[Any, ...], McpConnection]]:
+    return threading.Lock(), {}
+
+
+def get_mcp_client(spec: ToolChainSpec, url: str = MCP_BASE_URL, headers: Optional[Dict[str, str]] = None) -> McpConnection:
+    """Return the process-wide MCP connection for ``(url, headers)``, creating it on first use."""
+    headers = dict(headers or {})
+    key = (url, tuple(sorted(headers.items())))
+    lock, connections = _mcp_connections()
+    with lock:  # each browser session runs the script on its own thread
+        conn = connections.get(key)
+        if conn is None:
+            conn = McpConnection(url=url, headers=headers, client=_new_mcp_client(url, headers), results=spec.new_result_cache())
+            connections[key] = conn
+            atexit.register(_close_on_exit, conn)
+    return conn
+
+
+async def ensure_entered(conn: McpConnection) -> Client:
+    """Open the MCP session once and reuse it for every later chain.
+
+    A session is bound to the event loop it was opened on; if the loop changed
+    (e.g. the cached background loop was cleared), a fresh client is connected on the current loop.
+    """
+    loop = asyncio.get_running_loop()
+    async with conn.lock:
+        if conn.loop is not loop or not conn.client.is_connected():
+            if conn.loop is not None:
+                conn.client = _new_mcp_client(conn.url, conn.headers)
+            await asyncio.wait_for(conn.client.__aenter__(), MCP_CONNECT_TIMEOUT)
+            conn.loop = loop
+            _seed_tool_schemas(conn)
+    return conn.client
+
+
+async def _reconnect(conn: McpConnection, stale: Client) -> Client:
+    """Replace a session that stopped answering (e.g. the server restarted) with a fresh one.
+
+    Concurrent callers holding the same stale client share a single reconnect.
+    """
+    async with conn.lock:
+        if conn.client is stale:
+            conn.client = _new_mcp_client(conn.url, conn.headers)
+            conn.loop = None
+            # Close the old session in the background; against a dead server that can hang too.
+            task = asyncio.create_task(_close_stale(stale))
+            _closing.add(task)
+            task.add_done_callback(_closing.discard)
+    return await ensure_entered(conn)
+
+
+_closing: Set[asyncio.Task] = set()  # strong references to in-progress closes
+
+
+async def _close_stale(client: Client) -> None:
+    try:
+        await asyncio.wait_for(client.__aexit__(None, None, None), 2)
+    except Exception:
+        logging.debug("Could not close stale MCP session", exc_info=True)
+
+
+def _close_on_exit(conn: McpConnection) -> None:
+    """Close the connection's current MCP session on its own loop when the Streamlit server shuts down."""
+    loop = conn.loop
+    if loop is None or not loop.is_running() or not conn.client.is_connected():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(conn.client.__aexit__(None, None, None), loop).result(timeout=2)
+    except Exception:
+        logging.debug("Could not close MCP session cleanly", exc_info=True)
+
+
+# The MCP client lists the server's tools before the first call of each tool in a session, to
+# validate structured results. Listings are shared across sessions so a new browser session
+# or reconnect skips that round-trip; a failed call drops them so the next call re-lists.
+_tool_schemas: Dict[Tuple[Any, ...], Tuple[float, Dict[str, Any]]] = {}  # server -> (listed at, tool -> output schema)
+
+
+def _server_key(conn: McpConnection) -> Tuple[Any, ...]:
+    return (conn.url, tuple(sorted(conn.headers.items())))
+
+
+def _session_tool_schemas(client: Client) -> Optional[Dict[str, Any]]:
+    """The output-schema cache of the client's MCP session, if this client version has one."""
+    try:
+        schemas = getattr(client.session, "_tool_output_schemas", None)
+    except RuntimeError:  # not connected
+        return None
+    return schemas if isinstance(schemas, dict) else None
+
+
+def _seed_tool_schemas(conn: McpConnection) -> None:
+    """Pre-fill a freshly opened session with the server's recent tool listing."""
+    cached = _tool_schemas.get(_server_key(conn))
+    schemas = _session_tool_schemas(conn.client)
+    if cached is not None and schemas is not None and time.monotonic() - cached[0] < TOOL_SCHEMA_TTL:
+        schemas.update(cached[1])
+
+
+def _remember_tool_schemas(conn: McpConnection, client: Client) -> None:
+    key = _server_key(conn)
+    cached = _tool_schemas.get(key)
+    if cached is not None and time.monotonic() - cached[0] < TOOL_SCHEMA_TTL:
+        return
+    schemas = _session_tool_schemas(client)
+    if schemas:
+        _tool_schemas[key] = (time.monotonic(), dict(schemas))
+
+
+def _forget_tool_schemas(conn: McpConnection, client: Client) -> None:
+    _tool_schemas.pop(_server_key(conn), None)
+    schemas = _session_tool_schemas(client)
+    if schemas is not None:
+        schemas.clear()
+
+
+# -----------------------------------------------------------------------------
+# MCP execution step
+# -----------------------------------------------------------------------------
+# Errors that mean the session itself is unusable, rather than that the tool failed.
+_CONNECTION_ERRORS = (TimeoutError, httpx.TransportError, McpError, anyio.ClosedResourceError, anyio.BrokenResourceError)
+
+
+async def _call_tool_once(conn: McpConnection, client: Client, func: str, args: Dict[str, Any]) -> Any:
+    try:
+        return await asyncio.wait_for(client.call_tool(func, args, raise_on_error=False), MCP_CALL_TIMEOUT)
+    except TimeoutError:
+        _forget_tool_schemas(conn, client)
+        raise TimeoutError(f"No response from the MCP server within {MCP_CALL_TIMEOUT:g}s") from None
+    except Exception:
+        _forget_tool_schemas(conn, client)  # e.g. a result that no longer matches the listed schema
+        raise
+
+
+async def _call_tool(conn: McpConnection, client: Client, func: str, args: Dict[str, Any]) -> Any:
+    """``client.call_tool`` that keeps the shared tool listing in step with the server.
+
+    If the session looks dead (timeout or transport error), it reconnects once and retries
+    before letting the error through.
+    """
+    if conn.client is not client:
+        client = conn.client  # reconnected earlier in this chain
+    try:
+        result = await _call_tool_once(conn, client, func, args)
+    except _CONNECTION_ERRORS:
+        logging.info("MCP call to %s failed; reconnecting once", func, exc_info=True)
+        client = await _reconnect(conn, client)
+        result = await _call_tool_once(conn, client, func, args)
+    _remember_tool_schemas(conn, client)
+    return result
+
+
+def _result_cache_key(func: str, args: Dict[str, Any]) -> Optional[Tuple[Any, ...]]:
+    """Cache key for a tool call, or None if the arguments cannot be keyed.
+
+    Unhashable arguments (e.g. a whole earlier output passed via RESULT_N) are keyed by
+    their canonical JSON, so repeated calls with them are still shared.
+    """
+    key = (func, tuple(sorted(args.items())))
+    try:
+        hash(key)
+    except TypeError:
+        try:
+            return (func, json.dumps(args, sort_keys=True))
+        except (TypeError, ValueError):
+            return None
+    return key
+
+
+async def call_tool_cached(conn: McpConnection, client: Client, func: str, args: Dict[str, Any]) -> Any:
+    """Call a tool, sharing one in-flight or completed call per identical ``(func, args)``.
+
+    Failed calls are evicted so the next request retries them.
+    """
+    key = _result_cache_key(func, args)
+    if key is None:
+        return await _call_tool(conn, client, func, args)
+    fut = conn.results.get(key)
+    if fut is None:
+        fut = asyncio.get_running_loop().create_future()
+        conn.results[key] = fut
+        try:
+            result = await _call_tool(conn, client, func, args)
+        except BaseException as e:
+            conn.results.pop(key, None)
+            fut.set_exception(e)
+            fut.exception()  # mark as retrieved; concurrent waiters still receive it
+            raise
+        if getattr(result, "is_error", False):
+            conn.results.pop(key, None)
+        fut.set_result(result)
+        return result
+    return await fut
+
+
+async def _call_step(conn: McpConnection, client: Client, func: str, args: Dict[str, Any], step_view: Dict[str, Any]) -> None:
+    """Call one tool and record its output (and error marker, if any) on ``step_view``."""
+    try:
+        result = await call_tool_cached(conn, client, func, args)
+        step_view["output"] = result.data if result.data is not None else "<no output>"
+        if getattr(result, "is_error", False):
+            step_view["error"] = "Tool error"
+    except Exception as e:  # Network errors, timeouts, etc.
+        step_view["error"] = f"Execution error: {e}"
+
+
+def _collect_results(step_views: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Order executed step views by step index and drop everything after the first error."""
+    results: List[Dict[str, Any]] = []
+    for step_view in sorted(step_views, key=lambda v: v["step"]):
+        results.append(step_view)
+        if "error" in step_view:
+            break
+    return results
+
+
+# -----------------------------------------------------------------------------
+# Compiled replay of planned chains
+# -----------------------------------------------------------------------------
+ChainRunner = Callable[[McpConnection, Client], Awaitable[List[Dict[str, Any]]]]
+
+MAX_COMPILED_CHAINS = 1024
+_compiled_chains: Dict[str, ChainRunner] = {}  # plan fingerprint -> compiled runner
+
+
+def plan_fingerprint(steps: List[Any]) -> str:
+    """Canonical hash of a plan, used to look up its compiled runner."""
+    canonical = json.dumps([{"func": step.func, "args": step.args} for step in steps], sort_keys=True)
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+def compile_chain(steps: List[Any]) -> Optional[ChainRunner]:
+    """Generate a coroutine specialized to one plan, or None if it has a bad RESULT_N reference.
+
+    The generated code hardcodes each step's tool name, its literal arguments and the
+    RESULT_N wiring, so a replay skips reference resolution and wavefront scheduling. For ``(12 + 8) * 8`` it reads::
+
+        async def _run(conn, client):
+            v1 = {"step": 1, "func": 'add', "args": {"func": 'add', 'a': K[0], 'b': K[1]}}
+            await _gather(_call_step(conn, client, 'add', {'a': K[0], 'b': K[1]}, v1))
+            if "error" in v1: return _collect([v1])
+            r1 = v1["output"]
+            v2 = {"step": 2, "func": 'multiply', "args": {"func": 'multiply', 'a': r1, 'b': K[2]}}
+            ...
+    """
+    consts: List[Any] = []
+
+    def operand(value: Any, i: int) -> str:
+        if isinstance(value, str) and value.startswith("RESULT_"):
+            refs = find_result_refs(value)
+            if not refs or not 1 <= refs[0] < i:
+                raise ValueError(f"Bad result reference: {value}")
+            return f"r{refs[0]}"
+        consts.append(value)
+        return f"K[{len(consts) - 1}]"
+
+    lines = ["async def _run(conn, client):"]
+    views: List[str] = []
+    try:
+        for level in topo_levels(steps):
+            calls = []
+            for i in level:
+                step = steps[i - 1]
+                func = repr(step.func)
+                args = ", ".join(f"{k!r}: {operand(v, i)}" for k, v in step.args.items())
+                lines.append('    v%d = {"step": %d, "func": %s, "args": {"func": %s, %s}}' % (i, i, func, func, args))
+                calls.append("_call_step(conn, client, %s, {%s}, v%d)" % (func, args, i))
+                views.append(f"v{i}")
+            failed = " or ".join(f'"error" in v{i}' for i in level)
+            lines.append(f"    await _gather({', '.join(calls)})")
+            lines.append(f"    if {failed}: return _collect([{', '.join(views)}])")
+            lines.extend(f'    r{i} = v{i}["output"]' for i in level)
+    except ValueError:
+        return None
+    lines.append(f"    return _collect([{', '.join(views)}])")
+
+    namespace: Dict[str, Any] = {"K": consts, "_gather": asyncio.gather, "_call_step": _call_step, "_collect": _collect_results}
+    exec(compile("\n".join(lines), "<compiled chain>", "exec"), namespace)
+    return namespace["_run"]
+
+
+# -----------------------------------------------------------------------------
+# Chain execution
+# -----------------------------------------------------------------------------
+async def execute_chain_via_mcp(conn: McpConnection, steps: List[Any]) -> List[Dict[str, Any]]:
+    """Execute the planned steps against the MCP server.
+
+    Steps are dispatched one wavefront at a time (see ``topo_levels``); the calls in a
+    wavefront are issued concurrently, so a plan without RESULT_N references is a single
+    ``asyncio.gather``. Returns a list of dicts with keys: step, func, args,
+    output, error (optional), in step order. Stops after the wavefront containing the first
+    error and truncates the results after that step. The first run of a plan is interpreted;
+    later runs of the same plan use its compiled form.
+    """
+    client = await ensure_entered(conn)
+
+    # Replays of a known plan run its compiled form (see ``compile_chain``).
+    key = plan_fingerprint(steps)
+    runner = _compiled_chains.get(key)
+    if runner is not None:
+        return await runner(conn, client)
+
+    step_views: Dict[int, Dict[str, Any]] = {}
+    prior_outputs: Dict[int, Any] = {}
+
+    for level in topo_levels(steps):
+        calls = []
+        for i in level:
+            step = steps[i - 1]
+            step_view: Dict[str, Any] = {"step": i, "func": step.func}
+            step_views[i] = step_view
+            try:
+                # Resolve RESULT_N references
+                args = resolve_args(step.args, prior_outputs) if step.refs else step.args
+            except ValueError as e:
+                step_view["args"] = {"func": step.func, **step.args}
+                step_view["error"] = str(e)
+                continue
+            step_view["args"] = {"func": step.func, **args}
+            calls.append(_call_step(conn, client, step.func, args, step_view))
+
+        await asyncio.gather(*calls)
+
+        # Save outputs for RESULT_N references in later steps, in step order
+        failed = False
+        for i in level:
+            if "error" in step_views[i]:
+                failed = True
+            else:
+                prior_outputs[i] = step_views[i]["output"]
+        if failed:
+            break
+
+    results = _collect_results(list(step_views.values()))
+    if len(_compiled_chains) < MAX_COMPILED_CHAINS:
+        runner = compile_chain(steps)
+        if runner is not None:
+            _compiled_chains[key] = runner
+    return results
+
+
+async def execute_streamed_chain(
+    conn: McpConnection,
+    step_stream: AsyncIterator[Any],
+    prepare_args: Optional[Callable[[Any], Dict[str, Any]]] = None,
+) -> Tuple[List[Any], List[Dict[str, Any]]]:
+    """Execute steps while the plan is still being generated.
+
+    Steps arriving from ``step_stream`` are queued; each one is dispatched as soon as every
+    RESULT_N it references has an output, so the first tool calls overlap the rest of the
+    LLM response. ``prepare_args`` (e.g. filling in defaults) maps a step to the arguments
+    to call it with; by default ``step.args``. No new steps are dispatched after an error.
+    Returns the full plan and the step views (as from ``execute_chain_via_mcp``).
+    """
+    client = await ensure_entered(conn)
+    queue: asyncio.Queue[Optional[Any]] = asyncio.Queue()
+
+    async def produce() -> None:
+        try:
+            async for step in step_stream:
+                await queue.put(step)
+        finally:
+            await queue.put(None)  # end of plan
+
+    producer = asyncio.create_task(produce())
+    steps: List[Any] = []
+    step_views: Dict[int, Dict[str, Any]] = {}
+    prior_outputs: Dict[int, Any] = {}
+    waiting: List[int] = []
+    running: Dict[asyncio.Task, int] = {}
+    failed = False
+    next_step: Optional[asyncio.Task] = asyncio.create_task(queue.get())
+
+    while True:
+        # Dispatch every waiting step whose inputs are available.
+        for i in list(waiting):
+            if failed:
+                break
+            step = steps[i - 1]
+            if any(1 <= r < i and r not in prior_outputs for r in step.refs):
+                continue
+            waiting.remove(i)
+            prepared_args = prepare_args(step) if prepare_args is not None else step.args
+            step_view: Dict[str, Any] = {"step": i, "func": step.func}
+            step_views[i] = step_view
+            try:
+                args = resolve_args(prepared_args, prior_outputs) if step.refs else prepared_args
+            except ValueError as e:
+                step_view["args"] = {"func": step.func, **prepared_args}
+                step_view["error"] = str(e)
+                failed = True
+                break
+            step_view["args"] = {"func": step.func, **args}
+            running[asyncio.create_task(_call_step(conn, client, step.func, args, step_view))] = i
+
+        pending = set(running)
+        if next_step is not None:
+            pending.add(next_step)
+        if not pending:
+            break
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task is next_step:
+                step = task.result()
+                if step is None:
+                    next_step = None
+                else:
+                    steps.append(step)
+                    waiting.append(len(steps))
+                    next_step = asyncio.create_task(queue.get())
+            else:
+                i = running.pop(task)
+                if "error" in step_views[i]:
+                    failed = True
+                else:
+                    prior_outputs[i] = step_views[i]["output"]
+
+    await producer  # re-raise planning errors
+    return steps, _collect_results(list(step_views.values()))
+
+
+# -----------------------------------------------------------------------------
+# Presentation helpers
+# -----------------------------------------------------------------------------
+def show_json(obj: Any) -> None:
+    """``st.json`` with the payload pre-serialized (by orjson when installed)."""
+    text = None
+    if orjson is not None:
+        try:
+            text = orjson.dumps(obj, default=repr).decode()
+        except TypeError:  # e.g. non-string dict keys or integers beyond 64 bits
+            pass
+    st.json(text if text is not None else json.dumps(obj, default=repr))